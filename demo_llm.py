@@ -13,16 +13,66 @@ The conversation flow:
 
 Usage:
     python demo_llm.py
+
+GPU offload needs a llama-cpp-python wheel built with a GPU backend:
+    CMAKE_ARGS="-DGGML_CUDA=on" pip install --force-reinstall --no-cache-dir llama-cpp-python
+(use -DGGML_METAL=on on Apple Silicon). Set CRUCIBLE_GPU_LAYERS=0 to force CPU.
+CRUCIBLE_THREADS overrides the number of CPU threads used for decoding, and
+CRUCIBLE_BATCH_THREADS the number used for prompt evaluation (defaulting to
+CRUCIBLE_THREADS when only that is set, so both stay within the same cores).
 """
 
 import os
-import json
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
+import llama_cpp
+import orjson
 from llama_cpp import Llama
-from demo_tools import TOOL_SCHEMA, execute_tool
+from demo_tools import TOOLS_LIST, execute_tool, match_tool_call
+
+
+def _available_cpus() -> int:
+    """Count the logical CPUs this process may run on, honouring any affinity mask."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Model configuration. Q4_0 has the simplest dequantization kernel and decodes
+# fastest on CPU; set CRUCIBLE_MODEL to use another file such as the Q4_K_M quant.
+MODEL_PATH = os.environ.get("CRUCIBLE_MODEL", "./models/Phi-3.5-mini-instruct-Q4_0.gguf")
+
+# Decoding is memory-bound and suffers from SMT contention, so it uses one
+# thread per physical core (approximated as half the logical CPUs). Prompt
+# evaluation is compute-bound and gets every logical CPU, unless the user has
+# limited the thread count.
+N_THREADS = int(os.environ.get("CRUCIBLE_THREADS", max(1, _available_cpus() // 2)))
+N_THREADS_BATCH = int(os.environ.get(
+    "CRUCIBLE_BATCH_THREADS",
+    N_THREADS if "CRUCIBLE_THREADS" in os.environ else _available_cpus()
+))
+
+# Context window, in tokens
+N_CTX = 2048
+
+# Number of layers to offload to the GPU; -1 offloads all of them
+N_GPU_LAYERS = int(os.environ.get("CRUCIBLE_GPU_LAYERS", "-1"))
 
+# Most user turns kept in the prompt; going over trims history to half this
+MAX_HISTORY_TURNS = 12
 
-# Model configuration
-MODEL_PATH = "./models/Phi-3.5-mini-instruct-Q4_K_M.gguf"
+# Sampling for the reply written once a tool result is in context
+REPLY_STEP_PARAMS = {"temperature": 0.7, "max_tokens": 200}
+
+# Sampling for the first pass of a turn. This is usually a short tool call that
+# ends at its stop sequence, with low temperature for stable arguments, but a
+# question answered without a tool is answered here, so it keeps the full
+# reply budget rather than being cut off mid-sentence.
+TOOL_STEP_PARAMS = {
+    "temperature": 0.3,
+    "max_tokens": REPLY_STEP_PARAMS["max_tokens"],
+    "stop": ["</tool_call>"]
+}
 
 SYSTEM_PROMPT = """You are CRUCIBLE, a material science assistant that helps identify materials from spectroscopic data.
 
@@ -35,6 +85,266 @@ When users provide this data, use the tool to identify the material. If data is
 
 Be concise, scientific, and helpful. Explain your identifications briefly."""
 
+# Shared by every conversation so the prompt prefix is always the same object
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+@dataclass
+class PromptBuffer:
+    """
+    Message list split into a committed prefix and the turn in progress.
+    
+    llama.cpp reuses its KV cache for the longest token prefix shared with the
+    previous request, so committed messages are never edited or re-rendered.
+    The current turn (user message, tool calls, tool results) only ever grows
+    at the tail and is folded into the prefix once the final reply is known.
+    
+    Each committed turn's token count is recorded once, when it is committed,
+    so the history can be trimmed to a token budget. Its message count is
+    recorded alongside so whole turns can be dropped later.
+    """
+    prefix_messages: tuple[dict, ...]
+    pending_messages: list[dict] = field(default_factory=list)
+    turn_token_counts: list[int] = field(default_factory=list)
+    turn_sizes: list[int] = field(default_factory=list)
+    
+    def messages(self) -> list[dict]:
+        """Return the full message list to send to the model."""
+        return [*self.prefix_messages, *self.pending_messages]
+    
+    def append(self, message: dict):
+        """Add a message to the end of the current turn."""
+        self.pending_messages.append(message)
+    
+    def discard(self):
+        """Drop the current turn, e.g. one cut short by Ctrl+C or a Streamlit rerun."""
+        self.pending_messages = []
+    
+    def commit(self, n_tokens: int):
+        """
+        Move the current turn onto the end of the committed prefix.
+        
+        Args:
+            n_tokens: Token count of the current turn, from count_turn_tokens.
+        """
+        self.prefix_messages += tuple(self.pending_messages)
+        self.turn_token_counts.append(n_tokens)
+        self.turn_sizes.append(len(self.pending_messages))
+        self.pending_messages = []
+    
+    def trim(self, max_turns: int, max_tokens: int):
+        """
+        Drop the oldest committed turns once the turn or token limit is exceeded.
+        
+        Dropping a turn changes the prompt right after the system message, so
+        the next request re-evaluates the whole history. To keep that rare,
+        history over either limit is cut to half of both limits at once, which
+        leaves the prefix stable for several turns until the next cut.
+        
+        A turn is everything committed together, so tool calls stay with the
+        exchange that produced them. The system prompt at the head of the
+        prefix is always kept.
+        
+        Args:
+            max_turns: Most committed turns allowed before trimming.
+            max_tokens: Token budget for committed turns (see history_token_budget).
+        """
+        if (len(self.turn_token_counts) <= max_turns
+                and sum(self.turn_token_counts) <= max_tokens):
+            return
+        
+        kept = 0
+        used = 0
+        for n_tokens in reversed(self.turn_token_counts):
+            if kept == max_turns // 2 or used + n_tokens > max_tokens // 2:
+                break
+            kept += 1
+            used += n_tokens
+        
+        dropped = len(self.turn_token_counts) - kept
+        if not dropped:
+            return
+        
+        cut = 1 + sum(self.turn_sizes[:dropped])
+        self.prefix_messages = self.prefix_messages[:1] + self.prefix_messages[cut:]
+        del self.turn_token_counts[:dropped]
+        del self.turn_sizes[:dropped]
+
+
+def count_turn_tokens(llm: Llama, messages: list[dict]) -> int:
+    """
+    Count the tokens in one turn's messages, for context accounting.
+    
+    Messages are wrapped in Phi-3.5's role markers, so the count closely
+    tracks what the Phi-3.5 chat template renders for the same messages. For
+    a different model (see CRUCIBLE_MODEL) the count is only approximate: it
+    is off by that model's per-message template overhead.
+    
+    Args:
+        llm: The loaded model, for its tokenizer.
+        messages: The messages making up the turn.
+    
+    Returns:
+        Number of tokens in the turn.
+    """
+    parts = []
+    for msg in messages:
+        content = msg.get("content") or ""
+        for call in msg.get("tool_calls") or []:
+            content += call["function"]["arguments"]
+        parts.append(f"<|{msg['role']}|>\n{content}<|end|>\n")
+    return len(llm.tokenize("".join(parts).encode(), add_bos=False, special=True))
+
+
+def tool_messages(tool_call: dict, tool_result: str) -> list[dict]:
+    """
+    Return the messages that record a tool call and its result in the prompt.
+    
+    The model is prompted through the GGUF's own Phi-3.5 chat template, which
+    only renders system, user and assistant messages with string content. An
+    OpenAI-style assistant message with content None and "tool_calls" makes
+    it raise a TypeError, and "tool" messages are silently dropped. So the
+    call is written out as the assistant's text and the result is handed
+    back as a user message.
+    
+    Args:
+        tool_call: Tool call in OpenAI format, from the LLM or match_tool_call.
+        tool_result: JSON string returned by execute_tool.
+    
+    Returns:
+        An assistant message and a user message, in that order.
+    """
+    tool_name = tool_call["function"]["name"]
+    arguments = tool_call["function"]["arguments"]
+    return [
+        {"role": "assistant", "content": f"Calling {tool_name} with {arguments}"},
+        {"role": "user", "content": f"{tool_name} returned: {tool_result}"}
+    ]
+
+
+def history_token_budget(system_tokens: list[int]) -> int:
+    """
+    Return how many tokens of committed history fit in the context window.
+    
+    Room is reserved for the system prompt, a new turn's tool call and result,
+    and the reply. Turn sizes come from count_turn_tokens, so the budget
+    assumes the Phi-3.5 chat template.
+    
+    Args:
+        system_tokens: Token ids of the system prompt.
+    """
+    reserved = TOOL_STEP_PARAMS["max_tokens"] + REPLY_STEP_PARAMS["max_tokens"]
+    # Headroom for the new user message and the tool result
+    return N_CTX - len(system_tokens) - reserved - 256
+
+
+def gpu_offload_supported() -> bool:
+    """Return True if the installed llama-cpp-python build can offload to a GPU."""
+    return llama_cpp.llama_cpp.llama_supports_gpu_offload()
+
+
+def stream_message(chunks: Iterable[dict], message: dict) -> Iterator[str]:
+    """
+    Yield reply text from a streamed chat completion as it arrives.
+    
+    Tool-call deltas are not yielded: a call can only be dispatched once its
+    arguments are complete, so they are buffered instead. When the stream is
+    exhausted, message holds the assembled "content" and "tool_calls" in the
+    same shape as a non-streamed response message.
+    
+    Args:
+        chunks: Chunks returned by create_chat_completion(stream=True).
+        message: Dictionary to fill in with the assembled message.
+    
+    Yields:
+        Pieces of reply text, in order.
+    """
+    content = []
+    tool_calls = {}
+    
+    for chunk in chunks:
+        delta = chunk["choices"][0]["delta"]
+        
+        for call in delta.get("tool_calls") or []:
+            entry = tool_calls.setdefault(call["index"], {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if call.get("id"):
+                entry["id"] = call["id"]
+            function = call.get("function") or {}
+            entry["function"]["name"] += function.get("name") or ""
+            entry["function"]["arguments"] += function.get("arguments") or ""
+        
+        text = delta.get("content")
+        if text:
+            content.append(text)
+            if not tool_calls:
+                yield text
+    
+    message["content"] = "".join(content)
+    message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+
+
+# Shown when mlock_supported() is False; RLIMIT_MEMLOCK is the usual cause
+MLOCK_WARNING = (
+    "Model weights can't be locked in RAM and may be paged out; raise the "
+    "memlock limit (e.g. `ulimit -l unlimited`) before starting CRUCIBLE."
+)
+
+
+def mlock_supported(model_path: str) -> bool:
+    """
+    Return True if the model's weights can be locked in RAM with mlock.
+    
+    llama.cpp only logs a warning when locking fails, so check up front that
+    the build supports it and that RLIMIT_MEMLOCK is large enough for the file.
+    
+    Args:
+        model_path: Path to the GGUF model file.
+    """
+    if not llama_cpp.llama_cpp.llama_supports_mlock():
+        return False
+    
+    try:
+        import resource
+    except ImportError:
+        # No rlimits on Windows; llama.cpp grows the working set itself
+        return True
+    
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    return soft_limit == resource.RLIM_INFINITY or soft_limit >= os.path.getsize(model_path)
+
+
+def load_llm(model_path: str) -> Llama:
+    """
+    Load the model with CRUCIBLE's inference settings.
+    
+    Args:
+        model_path: Path to the GGUF model file.
+    
+    Returns:
+        Llama instance ready for inference.
+    """
+    llm = Llama(
+        model_path=model_path,
+        n_ctx=N_CTX,
+        n_threads=N_THREADS,
+        n_threads_batch=N_THREADS_BATCH,
+        n_gpu_layers=N_GPU_LAYERS,
+        offload_kqv=N_GPU_LAYERS != 0,
+        # Flash attention is required for the quantized V cache
+        flash_attn=True,
+        type_k=llama_cpp.GGML_TYPE_Q4_0,
+        type_v=llama_cpp.GGML_TYPE_Q4_0,
+        # Keep the weights resident so the first reply doesn't page them in
+        use_mmap=True,
+        use_mlock=mlock_supported(model_path),
+        verbose=False
+    )
+    return llm
+
 
 class CrucibleChat:
     """
@@ -44,33 +354,91 @@ class CrucibleChat:
     the tool-calling loop when the LLM decides to invoke identify_material.
     """
     
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, max_history_turns: int = MAX_HISTORY_TURNS):
         """
         Initialize the LLM and prepare for conversation.
         
         Args:
             model_path: Path to the GGUF model file.
+            max_history_turns: Number of past turns kept in the prompt.
         """
         print("Loading CRUCIBLE...")
         
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=2048,
-            n_threads=6,
-            n_gpu_layers=0,
-            verbose=False
-        )
-        self.history = []
+        if N_GPU_LAYERS != 0:
+            if gpu_offload_supported():
+                print("GPU offload: enabled")
+            else:
+                print("GPU offload: not supported by this llama-cpp-python build, running on CPU")
+        
+        if not mlock_supported(model_path):
+            print(f"Memory lock: {MLOCK_WARNING}")
+        
+        self.llm = load_llm(model_path)
+        # Tokenized once; the system prompt never changes between turns
+        self.system_tokens = self.llm.tokenize(SYSTEM_PROMPT.encode())
+        self.history_budget = history_token_budget(self.system_tokens)
+        self.prompt = PromptBuffer((SYSTEM_MESSAGE,))
+        self.max_history_turns = max_history_turns
         
         print("Ready.\n")
     
+    def _complete(self, params: dict) -> dict:
+        """
+        Run one completion over the current prompt, printing reply text as it streams.
+        
+        Args:
+            params: Sampling parameters, TOOL_STEP_PARAMS or REPLY_STEP_PARAMS.
+        
+        Returns:
+            The assembled assistant message (see stream_message).
+        """
+        chunks = self.llm.create_chat_completion(
+            messages=self.prompt.messages(),
+            tools=TOOLS_LIST,
+            tool_choice="auto",
+            stream=True,
+            **params
+        )
+        
+        message = {}
+        printed = False
+        for text in stream_message(chunks, message):
+            if not printed:
+                print("CRUCIBLE: ", end="")
+                printed = True
+            print(text, end="", flush=True)
+        if printed:
+            print("\n")
+        
+        return message
+    
+    def _call_tool(self, tool_call: dict):
+        """
+        Execute a tool call and append it, with its result, to the current turn.
+        
+        Args:
+            tool_call: Tool call in OpenAI format, from the LLM or match_tool_call.
+        """
+        tool_name = tool_call["function"]["name"]
+        tool_args = orjson.loads(tool_call["function"]["arguments"])
+        
+        print(f"\n[Tool: {tool_name}] {tool_args}")
+        tool_result = execute_tool(tool_name, tool_args)
+        print(f"[Result] {tool_result}\n")
+        
+        # Tool interaction stays at the tail, after the cached prefix
+        for message in tool_messages(tool_call, tool_result):
+            self.prompt.append(message)
+    
     def chat(self, user_message: str) -> str:
         """
-        Process a user message and return the assistant's response.
+        Process a user message, streaming the reply to stdout, and return it.
         
-        Handles the tool-calling loop: if the LLM requests a tool, we execute it,
-        append the result to the message chain, and let the LLM generate a final
-        response incorporating the tool output.
+        Runs at most two completions. The first decides whether to call
+        identify_material; if it does, we execute the tool, append the result
+        to the message chain, and a second completion writes the final response
+        incorporating the tool output. Messages that already spell out all
+        three tool arguments skip the first completion.
         
         Args:
             user_message: The user's input text.
@@ -78,57 +446,36 @@ class CrucibleChat:
         Returns:
             The assistant's final response string.
         """
-        self.history.append({"role": "user", "content": user_message})
-        
-        # Build full message list with system prompt
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + self.history
-        
-        # Tool-calling loop (max 3 iterations to prevent runaway)
-        for _ in range(3):
-            response = self.llm.create_chat_completion(
-                messages=messages,
-                temperature=0.7,
-                max_tokens=300,
-                tools=[TOOL_SCHEMA],
-                tool_choice="auto"
-            )
-            
-            message = response["choices"][0]["message"]
-            
-            # Check if LLM wants to call a tool
-            if message.get("tool_calls"):
+        # A previous turn that never finished must not merge into this one
+        self.prompt.discard()
+        self.prompt.append({"role": "user", "content": user_message})
+        
+        # Step 1: decide on a tool call, unless the message already spells it out
+        tool_call = match_tool_call(user_message)
+        if not tool_call:
+            message = self._complete(TOOL_STEP_PARAMS)
+            if message["tool_calls"]:
                 tool_call = message["tool_calls"][0]
-                tool_name = tool_call["function"]["name"]
-                tool_args = json.loads(tool_call["function"]["arguments"])
-                
-                print(f"\n[Tool: {tool_name}] {tool_args}")
-                tool_result = execute_tool(tool_name, tool_args)
-                print(f"[Result] {tool_result}\n")
-                
-                # Append tool interaction to message chain
-                messages.append({
-                    "role": "assistant",
-                    "content": None,
-                    "tool_calls": [tool_call]
-                })
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call["id"],
-                    "content": tool_result
-                })
-                # Loop continues - LLM will now respond with tool result in context
-            
-            else:
-                # No tool call - this is the final response
-                assistant_response = message["content"]
-                self.history.append({"role": "assistant", "content": assistant_response})
-                return assistant_response
         
-        return "I had trouble processing that request. Could you rephrase?"
+        # Step 2: respond with the tool result in context
+        if tool_call:
+            self._call_tool(tool_call)
+            message = self._complete(REPLY_STEP_PARAMS)
+        
+        assistant_response = message["content"]
+        if not assistant_response:
+            # No text, e.g. the reply asked for another tool call
+            assistant_response = "I had trouble processing that request. Could you rephrase?"
+            print(f"CRUCIBLE: {assistant_response}\n")
+        
+        self.prompt.append({"role": "assistant", "content": assistant_response})
+        self.prompt.commit(count_turn_tokens(self.llm, self.prompt.pending_messages))
+        self.prompt.trim(self.max_history_turns, self.history_budget)
+        return assistant_response
     
     def clear_history(self):
         """Reset conversation history."""
-        self.history = []
+        self.prompt = PromptBuffer((SYSTEM_MESSAGE,))
         print("Conversation cleared.\n")
 
 
@@ -179,8 +526,7 @@ def main():
                 print_help()
                 continue
             
-            response = crucible.chat(user_input)
-            print(f"CRUCIBLE: {response}\n")
+            crucible.chat(user_input)
         
         except KeyboardInterrupt:
             print("\nType 'exit' to quit.\n")
@@ -10,7 +10,8 @@ The tool schema follows the OpenAI function calling format, which llama-cpp-pyth
 supports natively for compatible models like Phi-3.5.
 """
 
-import json
+import re
+import orjson
 from tools import identify_material
 
 
@@ -49,6 +50,23 @@ TOOL_SCHEMA = {
     }
 }
 
+# The tools argument for create_chat_completion, built once and reused by every call
+TOOLS_LIST = [TOOL_SCHEMA]
+
+
+# Plausible argument ranges, matching the descriptions in TOOL_SCHEMA
+PEAK_RANGE = (100, 2000)
+FORMATION_ENERGY_RANGE = (-15, 0)
+
+_NUMBER_RE = re.compile(r"(-?\d+(?:\.\d+)?)")
+# Wavenumber units, stripped first so the "-1" exponent isn't read as a number
+_WAVENUMBER_RE = re.compile(r"cm\s*(?:\^?\s*-\s*1|⁻¹)", re.IGNORECASE)
+
+
+def _dumps(obj) -> str:
+    """Serialize obj to a JSON string, accepting numpy scalars from the model."""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
 
 def execute_tool(tool_name: str, arguments: dict) -> str:
     """
@@ -67,7 +85,7 @@ def execute_tool(tool_name: str, arguments: dict) -> str:
         or {"success": False, "error": ...}.
     """
     if tool_name != "identify_material":
-        return json.dumps({"success": False, "error": f"Unknown tool: {tool_name}"})
+        return _dumps({"success": False, "error": f"Unknown tool: {tool_name}"})
     
     try:
         result = identify_material(
@@ -75,12 +93,46 @@ def execute_tool(tool_name: str, arguments: dict) -> str:
             arguments["peak_2"],
             arguments["formation_energy"]
         )
-        return json.dumps({"success": True, "result": result})
+        return _dumps({"success": True, "result": result})
     
     except KeyError as e:
-        return json.dumps({"success": False, "error": f"Missing argument: {e}"})
+        return _dumps({"success": False, "error": f"Missing argument: {e}"})
     except Exception as e:
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})
+
+
+def match_tool_call(text: str) -> dict | None:
+    """
+    Build an identify_material call directly from a well-structured query.
+    
+    Queries such as "peaks at 465 and 610 cm^-1, formation energy -11.2" carry
+    all three arguments in plain sight, so there is no need to ask the LLM to
+    produce the tool call. The text must contain exactly three numbers: two
+    in PEAK_RANGE (taken in order as peak_1 and peak_2) and one in
+    FORMATION_ENERGY_RANGE. Anything else is left to the LLM.
+    
+    Args:
+        text: The user's input text.
+    
+    Returns:
+        A tool call in the same format the LLM emits, or None if the text
+        doesn't match.
+    """
+    numbers = [float(n) for n in _NUMBER_RE.findall(_WAVENUMBER_RE.sub(" ", text))]
+    if len(numbers) != 3:
+        return None
+    
+    peaks = [n for n in numbers if PEAK_RANGE[0] <= n <= PEAK_RANGE[1]]
+    energies = [n for n in numbers if FORMATION_ENERGY_RANGE[0] <= n <= FORMATION_ENERGY_RANGE[1]]
+    if len(peaks) != 2 or len(energies) != 1:
+        return None
+    
+    arguments = {"peak_1": peaks[0], "peak_2": peaks[1], "formation_energy": energies[0]}
+    return {
+        "id": "call_identify_material",
+        "type": "function",
+        "function": {"name": "identify_material", "arguments": _dumps(arguments)}
+    }
 
 
 if __name__ == "__main__":
@@ -92,4 +144,4 @@ if __name__ == "__main__":
     print(f"Input: {test_args}")
     
     result = execute_tool("identify_material", test_args)
-    print(f"Output: {json.loads(result)}")
+    print(f"Output: {orjson.loads(result)}")
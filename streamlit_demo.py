@@ -15,10 +15,30 @@ Usage:
 """
 
 import os
-import json
+import threading
+import orjson
 import streamlit as st
-from llama_cpp import Llama
-from demo_tools import TOOL_SCHEMA, execute_tool
+from llama_cpp import LlamaRAMCache
+from demo_llm import (
+    MAX_HISTORY_TURNS,
+    MLOCK_WARNING,
+    MODEL_PATH,
+    N_CTX,
+    N_GPU_LAYERS,
+    REPLY_STEP_PARAMS,
+    SYSTEM_MESSAGE,
+    SYSTEM_PROMPT,
+    TOOL_STEP_PARAMS,
+    PromptBuffer,
+    count_turn_tokens,
+    gpu_offload_supported,
+    history_token_budget,
+    load_llm,
+    mlock_supported,
+    stream_message,
+    tool_messages,
+)
+from demo_tools import TOOLS_LIST, execute_tool, match_tool_call
 
 
 # --- Page Configuration ---
@@ -30,18 +50,8 @@ st.set_page_config(
 )
 
 # --- Constants ---
-MODEL_PATH = "./models/Phi-3.5-mini-instruct-Q4_K_M.gguf"
-
-SYSTEM_PROMPT = """You are CRUCIBLE, a material science assistant that helps identify materials from spectroscopic data.
-
-Your main capability is identifying materials using Raman spectroscopy data. You have access to a tool called 'identify_material' that requires three parameters:
-- peak_1: First Raman peak in cm^-1
-- peak_2: Second Raman peak in cm^-1  
-- formation_energy: Formation energy in eV/atom
-
-When users provide this data, use the tool to identify the material. If data is missing, politely ask for it.
-
-Be concise, scientific, and helpful. Explain your identifications briefly."""
+# RAM budget for saved KV states, keyed by prompt prefix
+PROMPT_CACHE_BYTES = 1 << 30
 
 EXAMPLE_QUERIES = [
     "Identify material with peaks at 465 and 610 cm⁻¹, formation energy -11.2 eV/atom",
@@ -66,81 +76,242 @@ def load_model():
         st.info("Download the model first using the download script.")
         st.stop()
     
+    if N_GPU_LAYERS != 0 and not gpu_offload_supported():
+        st.warning("GPU offload is not supported by this llama-cpp-python build, running on CPU.")
+    if not mlock_supported(MODEL_PATH):
+        st.warning(MLOCK_WARNING)
+    
     with st.spinner("Loading CRUCIBLE model..."):
-        return Llama(
-            model_path=MODEL_PATH,
-            n_ctx=2048,
-            n_threads=6,
-            n_gpu_layers=0,
-            verbose=False
-        )
+        llm = load_llm(MODEL_PATH)
+        # Sessions take turns on the one model, so llama.cpp's in-context prefix
+        # match only covers whichever session ran last; the RAM cache restores
+        # the KV state of the others. (The single-conversation CLI doesn't need it.)
+        llm.set_cache(LlamaRAMCache(capacity_bytes=PROMPT_CACHE_BYTES))
+        return llm
+
+
+@st.cache_resource
+def llm_lock() -> threading.Lock:
+    """
+    Return the process-wide lock guarding the cached model.
+    
+    Cached like the model itself, since module-level objects are recreated
+    on every rerun and would not be shared between sessions.
+    """
+    return threading.Lock()
 
 
 # --- Core Chat Logic ---
+class _ToolFailed(Exception):
+    """Carries a failed tool result out of the cache so it is not stored."""
+    
+    def __init__(self, result: str):
+        super().__init__(result)
+        self.result = result
+
+
+@st.cache_data(show_spinner=False)
+def _cached_execute(tool_name: str, args_json: str) -> str:
+    """
+    Run execute_tool, memoized across reruns and sessions.
+    
+    Tools are deterministic, so repeated queries (e.g. the Example buttons)
+    reuse the stored result. Arguments are passed as canonical JSON so that
+    equal argument dicts share a cache entry. Failures (e.g. a missing model
+    file) may be transient, so they raise _ToolFailed, which st.cache_data
+    does not store.
+    """
+    result = execute_tool(tool_name, orjson.loads(args_json))
+    if not orjson.loads(result)["success"]:
+        raise _ToolFailed(result)
+    return result
+
+
+def call_tool(prompt: PromptBuffer, tool_call: dict) -> dict:
+    """
+    Execute a tool call and append it, with its result, to the current turn.
+    
+    Args:
+        prompt: The session's prompt buffer.
+        tool_call: Tool call in OpenAI format, from the LLM or match_tool_call.
+    
+    Returns:
+        Tool call info for display: name, args, and parsed result.
+    """
+    tool_name = tool_call["function"]["name"]
+    tool_args = orjson.loads(tool_call["function"]["arguments"])
+    args_json = orjson.dumps(tool_args, option=orjson.OPT_SORT_KEYS).decode()
+    try:
+        tool_result = _cached_execute(tool_name, args_json)
+    except _ToolFailed as e:
+        tool_result = e.result
+    
+    for message in tool_messages(tool_call, tool_result):
+        prompt.append(message)
+    
+    return {
+        "name": tool_name,
+        "args": tool_args,
+        "result": orjson.loads(tool_result)
+    }
+
+
+def complete(prompt: PromptBuffer, params: dict) -> dict:
+    """
+    Run one completion over the prompt, streaming reply text into the page.
+    
+    Args:
+        prompt: The session's prompt buffer.
+        params: Sampling parameters, TOOL_STEP_PARAMS or REPLY_STEP_PARAMS.
+    
+    Returns:
+        The assembled assistant message (see stream_message).
+    """
+    chunks = st.session_state.llm.create_chat_completion(
+        messages=prompt.messages(),
+        tools=TOOLS_LIST,
+        tool_choice="auto",
+        stream=True,
+        **params
+    )
+    
+    message = {}
+    st.write_stream(stream_message(chunks, message))
+    return message
+
+
 def get_response(user_message: str) -> tuple[str, list[dict]]:
     """
     Generate a response to the user's message, handling tool calls.
     
+    Runs at most two completions: one to decide on a tool call and, if a tool
+    was called, one to respond with its result. Messages that already spell
+    out all three tool arguments skip the first. The reply is streamed into
+    the current Streamlit container as it is generated.
+    
     Args:
         user_message: The user's input text.
     
     Returns:
         Tuple of (response_text, list_of_tool_call_info).
     """
-    # Build message history
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for msg in st.session_state.messages:
-        if msg["role"] in ("user", "assistant"):
-            messages.append({"role": msg["role"], "content": msg["content"]})
-    messages.append({"role": "user", "content": user_message})
+    prompt = st.session_state.prompt
+    # A previous turn that never finished must not merge into this one
+    prompt.discard()
+    prompt.append({"role": "user", "content": user_message})
     
     tool_calls_info = []
     
-    # Tool-calling loop
-    for _ in range(3):
-        response = st.session_state.llm.create_chat_completion(
-            messages=messages,
-            temperature=0.7,
-            max_tokens=300,
-            tools=[TOOL_SCHEMA],
-            tool_choice="auto"
-        )
+    # The model is shared by every session and llama.cpp is not reentrant,
+    # so completions (and their KV cache state) are serialized
+    with llm_lock():
+        # Step 1: decide on a tool call, unless the message already spells it out
+        tool_call = match_tool_call(user_message)
+        if not tool_call:
+            message = complete(prompt, TOOL_STEP_PARAMS)
+            if message["tool_calls"]:
+                tool_call = message["tool_calls"][0]
+        
+        # Step 2: respond with the tool result in context
+        if tool_call:
+            tool_calls_info.append(call_tool(prompt, tool_call))
+            message = complete(prompt, REPLY_STEP_PARAMS)
+    
+    response_text = message["content"]
+    if not response_text:
+        # No text, e.g. the reply asked for another tool call
+        response_text = "I had trouble processing that. Could you rephrase?"
+        st.markdown(response_text)
+    
+    prompt.append({"role": "assistant", "content": response_text})
+    prompt.commit(count_turn_tokens(st.session_state.llm, prompt.pending_messages))
+    prompt.trim(MAX_HISTORY_TURNS, st.session_state.history_budget)
+    return response_text, tool_calls_info
+
+
+def new_prompt() -> PromptBuffer:
+    """Start an empty conversation containing only the system prompt."""
+    return PromptBuffer((SYSTEM_MESSAGE,))
+
+
+# --- Chat Area ---
+def show_tool_details(tool_calls: list[dict]):
+    """Render one expander per tool call with its arguments and result."""
+    for tool in tool_calls:
+        with st.expander("🔧 Tool Details"):
+            st.json({
+                "tool": tool["name"],
+                "arguments": tool["args"],
+                "result": tool["result"]
+            })
+
+
+def show_message(msg: dict):
+    """Render a stored chat message and any tool calls it made."""
+    with st.chat_message(msg["role"]):
+        st.markdown(msg["content"])
+        show_tool_details(msg.get("tool_calls", []))
+
+
+@st.fragment
+def chat_area():
+    """
+    Handle new input and render the footer metrics.
+    
+    Runs as a fragment, so submitting a message reruns only this function
+    rather than the whole script. History up to the last full run is drawn
+    by the script itself; the fragment only draws messages added since then,
+    which it must redraw because each fragment run replaces its own output.
+    """
+    # Messages from earlier fragment runs since the last full run
+    for msg in st.session_state.messages[st.session_state.history_rendered:]:
+        show_message(msg)
+    
+    # Chat input; a clicked Example button takes the place of typed input
+    prompt = st.chat_input("Ask about materials or provide spectroscopic data...")
+    if "pending_prompt" in st.session_state:
+        prompt = st.session_state.pop("pending_prompt")
+    
+    if prompt:
+        st.session_state.messages.append({"role": "user", "content": prompt})
         
-        message = response["choices"][0]["message"]
+        with st.chat_message("user"):
+            st.markdown(prompt)
         
-        if message.get("tool_calls"):
-            tool_call = message["tool_calls"][0]
-            tool_name = tool_call["function"]["name"]
-            tool_args = json.loads(tool_call["function"]["arguments"])
-            tool_result = execute_tool(tool_name, tool_args)
+        with st.chat_message("assistant"):
+            with st.spinner("Thinking..."):
+                response, tool_calls = get_response(prompt)
             
-            tool_calls_info.append({
-                "name": tool_name,
-                "args": tool_args,
-                "result": json.loads(tool_result)
-            })
+            show_tool_details(tool_calls)
             
-            messages.append({
+            st.session_state.messages.append({
                 "role": "assistant",
-                "content": None,
-                "tool_calls": [tool_call]
-            })
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call["id"],
-                "content": tool_result
+                "content": response,
+                "tool_calls": tool_calls
             })
-        else:
-            return message["content"], tool_calls_info
+            st.session_state.tool_call_count += len(tool_calls)
+    
+    # --- Footer Metrics ---
+    st.divider()
     
-    return "I had trouble processing that. Could you rephrase?", tool_calls_info
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Messages", len(st.session_state.messages))
+    col2.metric("Tool Calls", st.session_state.tool_call_count)
+    col3.metric("Model", "🟢 Active")
 
 
 # --- Session State Initialization ---
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "prompt" not in st.session_state:
+    st.session_state.prompt = new_prompt()
+if "tool_call_count" not in st.session_state:
+    st.session_state.tool_call_count = 0
 if "llm" not in st.session_state:
     st.session_state.llm = load_model()
+    st.session_state.history_budget = history_token_budget(
+        st.session_state.llm.tokenize(SYSTEM_PROMPT.encode())
+    )
 
 
 # --- Sidebar ---
@@ -156,13 +327,15 @@ with st.sidebar:
     
     for i, query in enumerate(EXAMPLE_QUERIES, 1):
         if st.button(f"Example {i}", key=f"ex_{i}", use_container_width=True):
-            st.session_state.messages.append({"role": "user", "content": query})
-            st.rerun()
+            # Answered by the chat section below, later in this same run
+            st.session_state.pending_prompt = query
     
     st.divider()
     
     if st.button("🗑️ Clear Chat", use_container_width=True):
         st.session_state.messages = []
+        st.session_state.prompt = new_prompt()
+        st.session_state.tool_call_count = 0
         st.rerun()
     
     st.divider()
@@ -179,9 +352,9 @@ with st.sidebar:
     
     with st.expander("⚙️ Technical Details"):
         st.markdown(f"""
-        **Model:** Phi-3.5 Mini Instruct (Q4_K_M)  
+        **Model:** {os.path.basename(MODEL_PATH)}  
         **Parameters:** 3.8B  
-        **Context:** 2,048 tokens  
+        **Context:** {N_CTX:,} tokens  
         **Status:** ✅ Loaded
         """)
 
@@ -190,53 +363,10 @@ with st.sidebar:
 st.title("🔬 CRUCIBLE Material Identification")
 st.caption("Powered by Phi-3.5 Mini + ML Classification")
 
-# Display conversation history
+# Display conversation history; fragment reruns skip this and draw only
+# what has been added since
 for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
-        
-        if msg.get("tool_calls"):
-            for tool in msg["tool_calls"]:
-                with st.expander("🔧 Tool Details"):
-                    st.json({
-                        "tool": tool["name"],
-                        "arguments": tool["args"],
-                        "result": tool["result"]
-                    })
-
-# Chat input
-if prompt := st.chat_input("Ask about materials or provide spectroscopic data..."):
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    
-    with st.chat_message("user"):
-        st.markdown(prompt)
-    
-    with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            response, tool_calls = get_response(prompt)
-        
-        st.markdown(response)
-        
-        if tool_calls:
-            for tool in tool_calls:
-                with st.expander("🔧 Tool Details"):
-                    st.json({
-                        "tool": tool["name"],
-                        "arguments": tool["args"],
-                        "result": tool["result"]
-                    })
-        
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": response,
-            "tool_calls": tool_calls if tool_calls else []
-        })
-
-
-# --- Footer Metrics ---
-st.divider()
+    show_message(msg)
+st.session_state.history_rendered = len(st.session_state.messages)
 
-col1, col2, col3 = st.columns(3)
-col1.metric("Messages", len(st.session_state.messages))
-col2.metric("Tool Calls", sum(1 for m in st.session_state.messages if m.get("tool_calls")))
-col3.metric("Model", "🟢 Active")
+chat_area()